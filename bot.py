@@ -2,28 +2,44 @@ import os
 import re
 import logging
 import asyncio
-from datetime import datetime, time, timedelta
-from collections import deque, defaultdict
-from typing import Dict, Any, Optional, Set, Tuple, List
+import heapq
+from datetime import date, datetime, time, timedelta
+from enum import Enum
+from collections import OrderedDict, deque
+from typing import Dict, Any, FrozenSet, NamedTuple, Optional, Set, Tuple, List
 from difflib import SequenceMatcher
-import pytz
+from functools import lru_cache
+from itertools import count
+from time import monotonic
+from zoneinfo import ZoneInfo
 import io
-import textwrap
 import socket
-import base64
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import json
 import csv
 from pathlib import Path
+from types import MappingProxyType
 
 try:
     import asyncpg
 except Exception:
     asyncpg = None
 
+# Optional faster JSON for the registry backups (falls back to stdlib json)
+try:
+    import orjson
+except Exception:
+    orjson = None
+
 import httpx  # SendGrid HTTPS API
 
 from telegram import Update, Chat
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.ext import (
+    AIORateLimiter, ApplicationBuilder, BaseUpdateProcessor, CommandHandler, ContextTypes, Defaults,
+    MessageHandler, filters,
+)
 
 # Optional image rendering for transcript (falls back to text if Pillow missing)
 try:
@@ -32,25 +48,54 @@ try:
 except Exception:
     PIL_OK = False
 
+# Optional webhook server (python-telegram-bot[webhooks] pulls in tornado)
+try:
+    import tornado  # noqa: F401
+    WEBHOOKS_OK = True
+except Exception:
+    WEBHOOKS_OK = False
+
+# Optional HTTP/2 for Bot API calls (httpx[http2] pulls in h2); HTTP/1.1 keep-alive otherwise
+try:
+    import h2  # noqa: F401
+    HTTP2_OK = True
+except Exception:
+    HTTP2_OK = False
+
+# Optional faster event loop (libuv-based); the stock asyncio loop is used when it is not installed
+try:
+    import uvloop
+    UVLOOP_OK = True
+except Exception:
+    UVLOOP_OK = False
+
 # ---------------- Logging ----------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ---------------- Config ----------------
-TIMEZONE = pytz.timezone("America/Chicago")
+TIMEZONE = ZoneInfo("America/Chicago")
 
 def _csv_env(name: str) -> Set[str]:
     raw = os.getenv(name, "") or ""
     return {s.strip() for s in raw.split(",") if s.strip()}
 
+def _csv_env_ints(name: str) -> FrozenSet[int]:
+    """Parse a comma-separated env var of IDs once at import into an immutable int set."""
+    return frozenset(int(x) for x in _csv_env(name))
+
+# Chat IDs are kept as Telegram's native ints in memory (no str() per update); only JSON/DB use strings.
 # AIS/team groups (users seen here become authorized)
-AIS_TEAM_CHAT_IDS = _csv_env("AIS_TEAM_CHAT_IDS") or {"-4206463598", "-4181350900"}
+AIS_TEAM_CHAT_IDS = _csv_env_ints("AIS_TEAM_CHAT_IDS") or frozenset({-4206463598, -4181350900})
 
 # Authorized group chats = command-only mode (log + respond to commands, ignore everything else)
-SILENT_GROUP_IDS = _csv_env("SILENT_GROUP_IDS") or set(AIS_TEAM_CHAT_IDS)
+SILENT_GROUP_IDS = _csv_env_ints("SILENT_GROUP_IDS") or AIS_TEAM_CHAT_IDS
 
 # Preloaded authorized user IDs (comma-separated env)
-PREAUTHORIZED_USER_IDS = {int(x) for x in _csv_env("AUTHORIZED_USER_IDS")} if _csv_env("AUTHORIZED_USER_IDS") else set()
+PREAUTHORIZED_USER_IDS = _csv_env_ints("AUTHORIZED_USER_IDS")
+
+# Chat types that count as customer groups (checked on every message)
+GROUP_CHAT_TYPES = frozenset({Chat.GROUP, Chat.SUPERGROUP})
 
 # Office hours (CT)
 WEEKDAY_START = time(9, 0)
@@ -60,6 +105,14 @@ LAST_CALL_TIME = time(15, 0)   # 3:00 PM
 LUNCH_START = time(12, 30)
 LUNCH_END = time(13, 30)
 
+# The same boundaries as minutes since midnight, so the per-message classifiers compare plain ints.
+# Upper bounds are exclusive: 16:59 is still open, 17:00 is closed.
+WEEKDAY_START_MIN = WEEKDAY_START.hour * 60 + WEEKDAY_START.minute
+WEEKDAY_END_MIN = WEEKDAY_END.hour * 60 + WEEKDAY_END.minute
+WEEKDAY_CUTOFF_MIN = WEEKDAY_CUTOFF.hour * 60 + WEEKDAY_CUTOFF.minute
+LUNCH_START_MIN = LUNCH_START.hour * 60 + LUNCH_START.minute
+LUNCH_END_MIN = LUNCH_END.hour * 60 + LUNCH_END.minute
+
 # Env vars (NO SECRETS HARDCODED)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
@@ -83,9 +136,47 @@ EMAIL_DEFAULT_TO = os.getenv("EMAIL_TO", "info@myaisagency.com")
 EMAIL_ENDORSEMENT = os.getenv("EMAIL_ENDORSEMENT", "endorsements@myaisagency.com")
 EMAIL_COI = os.getenv("EMAIL_COI", "coi@myaisagency.com")
 
+# Validated once at startup; sends short-circuit on this instead of re-checking env per email
+EMAIL_CONFIG_ERROR: Optional[str] = (
+    "Missing SENDGRID_API_KEY" if not SENDGRID_API_KEY
+    else "Missing FROM_EMAIL" if not FROM_EMAIL
+    else None
+)
+
+# Dedicated, bounded worker pool for blocking email sends (keeps the default executor free)
+EMAIL_MAX_WORKERS = int(os.getenv("EMAIL_MAX_WORKERS", "4"))
+# Retries when SendGrid answers 429 (exponential backoff, honouring Retry-After)
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", "3"))
+
+# Optional webhook delivery: set WEBHOOK_URL to the public https base URL; unset = long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token so forged POSTs are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(24)
+
+# Event loop: "uring" (io_uring via uringcore, Linux 5.11+), "uv" (uvloop) or "default"; falls back uring -> uv -> default
+BOT_EVENT_LOOP = os.getenv("BOT_EVENT_LOOP", "uv").strip().lower()
+
 # Optional simple same-host conflict guard
 CONFLICT_GUARD_PORT = int(os.getenv("CONFLICT_GUARD_PORT", "37219"))
 
+# Outbound Telegram throttling (Bot API limits: ~30 msg/s overall, 20 msg/min per group)
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+# True once main() installs AIORateLimiter; without it, fan-outs fall back to fixed pacing below
+OUTBOUND_RATE_LIMITED = False
+# Spacing between fan-out sends when no rate limiter is installed (~8 msg/s, well under the ~30 msg/s limit)
+UNTHROTTLED_SEND_INTERVAL = 0.12
+# Keep-alive connections for Bot API calls (PTB's default is a single one, which fan-outs queue behind)
+TG_CONNECTION_POOL_SIZE = int(os.getenv("TG_CONNECTION_POOL_SIZE", "64"))
+
+# Updates processed at once across chats (each chat still runs strictly in order)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# Sends in flight at once during a fan-out (the rate limiter still paces them to Telegram's limits)
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "20"))
+# /refreshtitles looks up this many groups per batch and edits its progress message after each
+REFRESH_PROGRESS_EVERY = 25
+
 # ---------------- Messages ----------------
 CLOSED_MESSAGE_AM = (
     "🌅 Good morning!\n"
@@ -170,6 +261,44 @@ EMAILS_MESSAGE = (
     "• claims@myaisagency.com – Claims"
 )
 
+BUSINESS_HOURS_MESSAGE = (
+    "🕒 *Business Hours (CT)*\n"
+    "Mon–Fri: 9:00 AM – 5:00 PM\n"
+    "Lunch: 12:30 PM – 1:30 PM\n"
+    "Weekends: Closed"
+)
+
+HELP_MESSAGE = (
+    "🤖 Available commands (AIS TEAM only):\n"
+    "/start – Welcome\n"
+    "/help – This list\n"
+    "/myid – Your chat ID\n"
+    "/rules – Send & pin rules\n"
+    "/lt /apd /mvr /sign /emails – Quick replies\n"
+    "/time /hours – Business hours\n"
+    "/coi – COI instructions\n"
+    "/ssi – Email transcript to info@\n"
+    "/sse – Email transcript to endorsements@\n"
+    "/ssc – Email transcript to coi@\n"
+    "/who – List known groups (title + ID)\n"
+    "/broadcast – Send one-time announcement to all groups\n"
+    "/broadcastexcept – Send a photo + caption to all groups except the permanent exclusion list\n"
+    "/broadcastpin – Broadcast and try to pin in all groups\n"
+    "/broadcastto – Targeted broadcast to specific group(s) by ID or name\n"
+    "/ASPE – Send English ASP introduction + save group to ASP EN list\n"
+    "/ASPR – Send Russian ASP introduction + save group to ASP RU list\n"
+    "/OAE – Send the English Occupational Accident image and text\n"
+    "/aspcount – Show ASP English/Russian/unique group counts\n"
+    "/aspwho – List saved ASP groups in safe chunks\n"
+    "/aspbroadcaste – Broadcast text to ASP English groups only\n"
+    "/aspbroadcastr – Broadcast text to ASP Russian groups only\n"
+    "/aspbroadcast – Broadcast text to all unique ASP groups\n"
+    "/refreshtitles – Recover/update names from Telegram\n"
+    "/findgroup – Search company name and show chat IDs\n"
+    "/exportgroups – Download all names and IDs as CSV\n"
+    "/matchinsured – Match insured list and export chat IDs"
+)
+
 
 ASP_ENGLISH_TEXT = (
     "WE'RE EXCITED TO INTRODUCE ADVANCED SAFETY PARTNERS!\n\n"
@@ -212,9 +341,10 @@ OA_ENGLISH_TEXT = (
 )
 
 
-COMMAND_MESSAGES = {
-    "lt": "📄 Please send us the Lease Termination to proceed with removal. This is required.",
-    "apd": (
+# command -> (reply text, parse_mode); plain-text replies skip Telegram's Markdown parse entirely
+COMMAND_MESSAGES = MappingProxyType({
+    "lt": ("📄 Please send us the Lease Termination to proceed with removal. This is required.", None),
+    "apd": ((
         "📝 Please send the following details to Pavel@myaisagency.com:\n"
         "- Corporation name\n"
         "- Phone number\n"
@@ -222,30 +352,73 @@ COMMAND_MESSAGES = {
         "- CDLs\n"
         "- Truck VINs with values\n\n"
         "✅ Kindly include everything in one email."
-    ),
-    "mvr": (
+    ), None),
+    "mvr": ((
         "📋 Please send us MVRs for the drivers you'd like to add to the policy.\n\n"
         "If you’d like us to order the MVR:\n"
         "🛠️ Send all necessary driver info\n"
         "💵 Note: $30 fee applies per MVR\n"
         "🧾 PA drivers must include the last 4 digits of their SSN"
-    ),
-    "sign": (
+    ), None),
+    "sign": ((
         "📬 Please check your email — we’ve sent your documents for **e-signature**.\n"
         "Kindly review and sign at your earliest convenience. If you have any questions, reply here and we’ll help. "
         "Thank you! ✍️😊"
-    ),
-    "emails": EMAILS_MESSAGE,
-}
+    ), "Markdown"),
+    "emails": (EMAILS_MESSAGE, "Markdown"),
+})
 
 # ---------------- State ----------------
-chat_last_response: Dict[str, Dict[str, str]] = {}
+# (chat_id, tag) -> monotonic() of the last send; only ever compared as an elapsed duration
+chat_last_response: Dict[Tuple[int, str], float] = {}
+
+
+class TranscriptEntry(NamedTuple):
+    """One captured chat line (tuple-backed: no per-message dict)."""
+    ts: str
+    name: str
+    text: str
+
+
 TRANSCRIPT_MAX_MESSAGES = 5
-chat_buffers: Dict[str, deque] = defaultdict(lambda: deque(maxlen=TRANSCRIPT_MAX_MESSAGES))
-known_group_chats: Dict[str, Dict[str, Any]] = {}
+TRANSCRIPT_MAX_CHATS = int(os.getenv("TRANSCRIPT_MAX_CHATS", "4096"))
+# LRU by chat activity: the least recently active chat's buffer is evicted past TRANSCRIPT_MAX_CHATS
+chat_buffers: "OrderedDict[int, deque]" = OrderedDict()
+# Keyed by int chat_id in memory; JSON keys and the DB column are the string form
+known_group_chats: Dict[int, Dict[str, Any]] = {}
 asp_group_chats: Dict[str, Dict[str, Any]] = {}
 
 
+def _json_load_file(path: Path, default: str) -> Any:
+    data = path.read_bytes() or default.encode()
+    return orjson.loads(data) if orjson else json.loads(data.decode("utf-8"))
+
+
+def _json_write_file(path: Path, data: Any) -> None:
+    """Atomically write `data` as indented UTF-8 JSON (temp file + rename)."""
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    if orjson:
+        tmp.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(path)
+
+
+def _parse_chat_id(value: Any) -> Optional[int]:
+    """Chat ID from a JSON/DB/env value (str or int); None if it is not an integer."""
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    """Datetime from a stored ISO string; None if it is missing or malformed."""
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
 def _normalize_group_record(chat_id: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     meta = meta or {}
     now_iso = now_in_timezone().isoformat()
@@ -256,13 +429,13 @@ def _normalize_group_record(chat_id: str, meta: Optional[Dict[str, Any]] = None)
     }
 
 
-def merge_known_group(chat_id: str, title: str = "", added_on: Optional[str] = None, last_seen: Optional[str] = None) -> bool:
+def merge_known_group(chat_id: Any, title: str = "", added_on: Optional[str] = None, last_seen: Optional[str] = None) -> bool:
     """
     Add/update one group in memory. Returns True if anything changed.
-    Uses chat_id as the dictionary key, so duplicates are impossible.
+    Uses the int chat_id as the dictionary key, so duplicates are impossible.
     """
-    cid = str(chat_id).strip()
-    if not cid:
+    cid = _parse_chat_id(chat_id)
+    if cid is None:
         return False
 
     existing = known_group_chats.get(cid)
@@ -299,14 +472,14 @@ def load_known_groups_from_json() -> int:
         logger.info(f"No {GROUP_CHATS_FILE} found yet; starting with empty JSON backup.")
         return 0
     try:
-        raw = json.loads(path.read_text(encoding="utf-8") or "{}")
+        raw = _json_load_file(path, "{}")
         loaded = 0
         if isinstance(raw, dict):
             for cid, meta in raw.items():
                 if isinstance(meta, dict):
-                    changed = merge_known_group(str(cid), meta.get("title") or meta.get("group_name") or "", meta.get("added_on") or meta.get("added_at"), meta.get("last_seen"))
+                    changed = merge_known_group(cid, meta.get("title") or meta.get("group_name") or "", meta.get("added_on") or meta.get("added_at"), meta.get("last_seen"))
                 else:
-                    changed = merge_known_group(str(cid))
+                    changed = merge_known_group(cid)
                 if changed:
                     loaded += 1
         elif isinstance(raw, list):
@@ -314,11 +487,11 @@ def load_known_groups_from_json() -> int:
                 if isinstance(item, dict):
                     cid = item.get("chat_id") or item.get("id")
                     if cid:
-                        changed = merge_known_group(str(cid), item.get("title") or item.get("group_name") or "", item.get("added_on") or item.get("added_at"), item.get("last_seen"))
+                        changed = merge_known_group(cid, item.get("title") or item.get("group_name") or "", item.get("added_on") or item.get("added_at"), item.get("last_seen"))
                         if changed:
                             loaded += 1
                 else:
-                    changed = merge_known_group(str(item))
+                    changed = merge_known_group(item)
                     if changed:
                         loaded += 1
         logger.info(f"Loaded {len(known_group_chats)} unique groups from JSON backup/merge.")
@@ -331,11 +504,8 @@ def load_known_groups_from_json() -> int:
 def save_known_groups_to_json() -> None:
     """Save unique in-memory groups to local JSON backup using atomic write."""
     try:
-        path = Path(GROUP_CHATS_FILE)
-        tmp = path.with_suffix(path.suffix + ".tmp")
-        data = dict(sorted(known_group_chats.items(), key=lambda kv: kv[0]))
-        tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
-        tmp.replace(path)
+        data = {str(cid): meta for cid, meta in known_group_chats.items()}
+        _json_write_file(Path(GROUP_CHATS_FILE), dict(sorted(data.items())))
         logger.info(f"JSON backup saved: {len(data)} unique groups in {GROUP_CHATS_FILE}")
     except Exception as e:
         logger.exception(f"Failed to save {GROUP_CHATS_FILE}: {e}")
@@ -369,6 +539,22 @@ async def init_db():
                     PRIMARY KEY (chat_id, activity_date)
                 )
             """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_spiel_state (
+                    chat_id TEXT PRIMARY KEY,
+                    closed_am_sent_on TEXT,
+                    closed_pm_sent_on TEXT,
+                    last_auth_msg_at TEXT
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending_prompts (
+                    chat_id TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    fire_at TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, period)
+                )
+            """)
         logger.info("PostgreSQL persistence initialized.")
     except Exception as e:
         db_pool = None
@@ -392,7 +578,7 @@ async def load_known_groups_from_db() -> int:
         return 0
 
 
-async def save_group_to_db(chat_id: str, title: str = "") -> None:
+async def save_group_to_db(chat_id: int, title: str = "") -> None:
     if not db_pool:
         return
     now_iso = now_in_timezone().isoformat()
@@ -410,11 +596,11 @@ async def save_group_to_db(chat_id: str, title: str = "") -> None:
         logger.exception(f"Failed to save group {chat_id} to PostgreSQL: {e}")
 
 
-async def persist_known_group(chat_id: str, title: str = "") -> None:
+async def persist_known_group(chat_id: int, title: str = "") -> None:
     """Save to both JSON and PostgreSQL. Broadcasts stay duplicate-safe because memory is keyed by chat_id."""
-    merge_known_group(str(chat_id), title=title or "", last_seen=now_in_timezone().isoformat())
+    merge_known_group(chat_id, title=title or "", last_seen=now_in_timezone().isoformat())
     save_known_groups_to_json()
-    await save_group_to_db(str(chat_id), title or "")
+    await save_group_to_db(chat_id, title or "")
 
 
 async def sync_all_known_groups_to_db() -> None:
@@ -426,14 +612,18 @@ async def sync_all_known_groups_to_db() -> None:
     logger.info(f"Synced {len(known_group_chats)} unique groups into PostgreSQL.")
 
 
-async def mark_daily_activity(chat_id: str) -> None:
-    """Remember that a group was active today, both in memory and PostgreSQL."""
-    cid = str(chat_id)
-    now = now_in_timezone()
-    day = now.strftime("%Y-%m-%d")
-    LAST_CHAT_ACTIVITY[cid] = day
-    if not db_pool:
+async def mark_daily_activity(chat_id: int, now: Optional[datetime] = None) -> None:
+    """Remember that a group was active today, both in memory and PostgreSQL (one DB write per group per day)."""
+    now = now or now_in_timezone()
+    roll_chat_activity(now)
+    TODAY_ACTIVE.add(chat_id)
+    # Only a successful write marks the chat saved; a failed one is retried on its next message.
+    day = TODAY_ACTIVE_DAY[0]
+    # Keyed by day, so a write still in flight across midnight never blocks the new day's first write.
+    saving_key = (day, chat_id)
+    if not db_pool or chat_id in TODAY_SAVED or saving_key in TODAY_SAVING:
         return
+    TODAY_SAVING.add(saving_key)
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("""
@@ -441,26 +631,163 @@ async def mark_daily_activity(chat_id: str) -> None:
                 VALUES ($1, $2, $3)
                 ON CONFLICT (chat_id, activity_date)
                 DO UPDATE SET last_activity_at = EXCLUDED.last_activity_at
-            """, cid, day, now.isoformat())
+            """, str(chat_id), day_str(now), now.isoformat())
+        if TODAY_ACTIVE_DAY[0] == day:  # the day may have rolled over while the write was in flight
+            TODAY_SAVED.add(chat_id)
     except Exception as e:
-        logger.exception(f"Failed to save daily activity for {cid}: {e}")
+        logger.exception(f"Failed to save daily activity for {chat_id} (will retry on its next message): {e}")
+    finally:
+        TODAY_SAVING.discard(saving_key)
 
 
-async def get_active_group_ids(activity_date: str) -> Set[str]:
-    targets = {cid for cid, day in LAST_CHAT_ACTIVITY.items() if day == activity_date}
+def roll_chat_activity(now: datetime) -> None:
+    """
+    Start a fresh TODAY_ACTIVE set when the CT day of `now` changes; only today's entries are ever queried.
+    Every path that advances the day prunes here, so the daily prune cannot be skipped.
+    """
+    day = now.date()
+    if TODAY_ACTIVE_DAY[0] != day:
+        TODAY_ACTIVE_DAY[0] = day
+        TODAY_ACTIVE.clear()
+        TODAY_SAVED.clear()
+        prune_stale_chat_state(now)
+
+
+def prune_stale_chat_state(now: datetime) -> None:
+    """Once a day, drop per-chat entries no rule can consult any more (all are at most same-day)."""
+    today = now.date()
+    cutoff = now - timedelta(days=1)
+    for sent_today in (CLOSED_SENT_TODAY_AM, CLOSED_SENT_TODAY_PM):
+        for cid in [cid for cid, day in sent_today.items() if day != today]:
+            del sent_today[cid]
+    for cid in [cid for cid, ts in LAST_AUTH_MSG_AT.items() if ts < cutoff]:
+        del LAST_AUTH_MSG_AT[cid]
+    sent_cutoff = monotonic() - 86400
+    for key in [key for key, when in chat_last_response.items() if when < sent_cutoff]:
+        del chat_last_response[key]
+
+
+async def get_active_group_ids(activity_date: date) -> Set[int]:
+    targets = set(TODAY_ACTIVE) if TODAY_ACTIVE_DAY[0] == activity_date else set()
     if db_pool:
         try:
             async with db_pool.acquire() as conn:
                 rows = await conn.fetch(
                     "SELECT chat_id FROM daily_group_activity WHERE activity_date = $1",
-                    activity_date,
+                    activity_date.isoformat(),
                 )
-            targets.update(str(row["chat_id"]) for row in rows)
+            for row in rows:
+                cid = _parse_chat_id(row["chat_id"])
+                if cid is None:
+                    logger.warning(f"Skipping malformed chat_id in daily_group_activity: {row['chat_id']!r}")
+                    continue
+                targets.add(cid)
         except Exception as e:
             logger.exception(f"Failed to load active groups for {activity_date}: {e}")
     return targets
 
 
+async def load_spiel_state_from_db(now: datetime) -> List[Tuple[int, str, datetime]]:
+    """
+    Restore today's closed-spiel marks and recent authorized-message times from before the last restart.
+    Returns the flood buffers that were still pending at shutdown as (chat_id, period, fire_at).
+    """
+    if not db_pool:
+        return []
+    today = now.date()
+    cutoff = now - timedelta(days=1)
+    pending: List[Tuple[int, str, datetime]] = []
+    try:
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT chat_id, closed_am_sent_on, closed_pm_sent_on, last_auth_msg_at FROM chat_spiel_state"
+            )
+            prompt_rows = await conn.fetch("SELECT chat_id, period, fire_at FROM pending_prompts")
+        for row in rows:
+            cid = _parse_chat_id(row["chat_id"])
+            if cid is None:
+                continue
+            if row["closed_am_sent_on"] == today.isoformat():
+                CLOSED_SENT_TODAY_AM[cid] = today
+            if row["closed_pm_sent_on"] == today.isoformat():
+                CLOSED_SENT_TODAY_PM[cid] = today
+            ts = _parse_timestamp(row["last_auth_msg_at"])
+            if ts and ts >= cutoff:
+                LAST_AUTH_MSG_AT[cid] = ts
+        for row in prompt_rows:
+            cid = _parse_chat_id(row["chat_id"])
+            fire_at = _parse_timestamp(row["fire_at"])
+            if cid is not None and fire_at and row["period"] in _PERIOD_SEND_STATES:
+                pending.append((cid, row["period"], fire_at))
+        logger.info(f"Loaded spiel state for {len(rows)} chats and {len(pending)} pending prompts from PostgreSQL.")
+    except Exception as e:
+        logger.exception(f"Failed to load spiel state from PostgreSQL: {e}")
+    return pending
+
+
+async def flush_spiel_state() -> None:
+    """Write chats whose spiel state changed (and the pending flood buffers, if any moved) in one transaction."""
+    if not db_pool or not (SPIEL_STATE_DIRTY or PENDING_PROMPTS_DIRTY[0]):
+        return
+    dirty = list(SPIEL_STATE_DIRTY)
+    SPIEL_STATE_DIRTY.clear()
+    pending_dirty = PENDING_PROMPTS_DIRTY[0]
+    PENDING_PROMPTS_DIRTY[0] = False
+
+    state_rows = []
+    for cid in dirty:
+        am = CLOSED_SENT_TODAY_AM.get(cid)
+        pm = CLOSED_SENT_TODAY_PM.get(cid)
+        auth = LAST_AUTH_MSG_AT.get(cid)
+        state_rows.append((
+            str(cid),
+            am.isoformat() if am else None,
+            pm.isoformat() if pm else None,
+            auth.isoformat() if auth else None,
+        ))
+    # Flood deadlines are monotonic; store wall-clock fire times so they survive a restart.
+    now, mono = now_in_timezone(), monotonic()
+    prompt_rows = [
+        (str(cid), period, (now + timedelta(seconds=deadline - mono)).isoformat())
+        for (cid, period), deadline in FLOOD_DEADLINE.items()
+    ] if pending_dirty else []
+
+    saved = False
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                if state_rows:
+                    await conn.executemany("""
+                        INSERT INTO chat_spiel_state (chat_id, closed_am_sent_on, closed_pm_sent_on, last_auth_msg_at)
+                        VALUES ($1, $2, $3, $4)
+                        ON CONFLICT (chat_id)
+                        DO UPDATE SET closed_am_sent_on = EXCLUDED.closed_am_sent_on,
+                                      closed_pm_sent_on = EXCLUDED.closed_pm_sent_on,
+                                      last_auth_msg_at = EXCLUDED.last_auth_msg_at
+                    """, state_rows)
+                if pending_dirty:
+                    await conn.execute("DELETE FROM pending_prompts")
+                    if prompt_rows:
+                        await conn.executemany(
+                            "INSERT INTO pending_prompts (chat_id, period, fire_at) VALUES ($1, $2, $3)",
+                            prompt_rows,
+                        )
+        saved = True
+    except Exception as e:
+        logger.exception(f"Failed to save spiel state to PostgreSQL (will retry): {e}")
+    finally:
+        if not saved:  # also when cancelled mid-write at shutdown, so the final flush still covers it
+            SPIEL_STATE_DIRTY.update(dirty)
+            PENDING_PROMPTS_DIRTY[0] = PENDING_PROMPTS_DIRTY[0] or pending_dirty
+
+
+async def spiel_state_flusher() -> None:
+    """Batch spiel-state writes: at most one PostgreSQL round-trip every SPIEL_STATE_FLUSH_SECONDS."""
+    while True:
+        await asyncio.sleep(SPIEL_STATE_FLUSH_SECONDS)
+        await flush_spiel_state()
+
+
 def merge_asp_group(chat_id: str, language: str, title: str = "",
                     first_sent_at: Optional[str] = None, last_sent_at: Optional[str] = None) -> bool:
     """Merge one ASP group/language into memory. Duplicate-safe by chat_id + language."""
@@ -501,7 +828,7 @@ def load_asp_groups_from_json() -> int:
         logger.info(f"No {ASP_GROUP_CHATS_FILE} found yet; starting with empty ASP JSON backup.")
         return 0
     try:
-        raw = json.loads(path.read_text(encoding="utf-8") or "{}")
+        raw = _json_load_file(path, "{}")
         loaded = 0
         if isinstance(raw, dict):
             for cid, meta in raw.items():
@@ -530,11 +857,8 @@ def load_asp_groups_from_json() -> int:
 
 def save_asp_groups_to_json() -> None:
     try:
-        path = Path(ASP_GROUP_CHATS_FILE)
-        tmp = path.with_suffix(path.suffix + ".tmp")
         data = dict(sorted(asp_group_chats.items(), key=lambda kv: kv[0]))
-        tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
-        tmp.replace(path)
+        _json_write_file(Path(ASP_GROUP_CHATS_FILE), data)
         logger.info(f"ASP JSON backup saved: {len(data)} unique ASP groups.")
     except Exception as e:
         logger.exception(f"Failed to save {ASP_GROUP_CHATS_FILE}: {e}")
@@ -645,10 +969,26 @@ def get_asp_targets(language: Optional[str] = None) -> List[int]:
     return list(dict.fromkeys(targets))
 
 
+# Telegram file_id per campaign image: after the first upload the photo is re-sent by reference
+PHOTO_FILE_IDS: Dict[Path, str] = {}
+
+
+async def _send_campaign_photo(bot, chat_id: int, image_path: Path, caption: str):
+    """Send a local campaign image, uploading it from disk only the first time."""
+    file_id = PHOTO_FILE_IDS.get(image_path)
+    if file_id:
+        return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+    with image_path.open("rb") as photo:
+        sent = await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+    if sent and sent.photo:
+        PHOTO_FILE_IDS[image_path] = sent.photo[-1].file_id
+    return sent
+
+
 async def _send_asp_intro(update: Update, context: ContextTypes.DEFAULT_TYPE,
                           language: str, image_path: Path, caption: str) -> None:
     chat = update.effective_chat
-    if not chat or chat.type not in (Chat.GROUP, Chat.SUPERGROUP):
+    if not chat or chat.type not in GROUP_CHAT_TYPES:
         await update.message.reply_text("Please use this command inside the insured group chat.")
         return
 
@@ -658,8 +998,7 @@ async def _send_asp_intro(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return
 
     try:
-        with image_path.open("rb") as photo:
-            await context.bot.send_photo(chat_id=chat.id, photo=photo, caption=caption)
+        await _send_campaign_photo(context.bot, chat.id, image_path, caption)
 
         # Save only after Telegram confirms the ASP post was sent successfully.
         await persist_asp_group(str(chat.id), language, chat.title or "")
@@ -678,24 +1017,20 @@ async def _send_asp_intro(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
 
 
-def load_broadcast_exclusions() -> Set[str]:
+def load_broadcast_exclusions() -> Set[int]:
     """Load permanent /broadcastexcept exclusions. Supports a JSON list of IDs or objects with chat_id."""
     path = Path(BROADCAST_EXCLUSIONS_FILE)
     if not path.exists():
         logger.warning(f"{BROADCAST_EXCLUSIONS_FILE} is missing; /broadcastexcept will exclude 0 groups.")
         return set()
     try:
-        raw = json.loads(path.read_text(encoding="utf-8") or "[]")
-        result: Set[str] = set()
-        if isinstance(raw, list):
-            for item in raw:
-                cid = item.get("chat_id") if isinstance(item, dict) else item
-                if cid is not None and str(cid).strip():
-                    result.add(str(cid).strip())
-        elif isinstance(raw, dict):
-            for cid in raw.keys():
-                if str(cid).strip():
-                    result.add(str(cid).strip())
+        raw = _json_load_file(path, "[]")
+        items = raw if isinstance(raw, list) else list(raw) if isinstance(raw, dict) else []
+        result: Set[int] = set()
+        for item in items:
+            cid = _parse_chat_id(item.get("chat_id") if isinstance(item, dict) else item)
+            if cid is not None:
+                result.add(cid)
         return result
     except Exception as e:
         logger.exception(f"Failed to load {BROADCAST_EXCLUSIONS_FILE}: {e}")
@@ -705,7 +1040,7 @@ def load_broadcast_exclusions() -> Set[str]:
 async def _send_oa_intro(update: Update, context: ContextTypes.DEFAULT_TYPE,
                          image_path: Path, caption: str) -> None:
     chat = update.effective_chat
-    if not chat or chat.type not in (Chat.GROUP, Chat.SUPERGROUP):
+    if not chat or chat.type not in GROUP_CHAT_TYPES:
         await update.message.reply_text("Please use this command inside the insured group chat.")
         return
     if not image_path.exists():
@@ -713,8 +1048,7 @@ async def _send_oa_intro(update: Update, context: ContextTypes.DEFAULT_TYPE,
         logger.error(f"Missing Occupational Accident image: {image_path}")
         return
     try:
-        with image_path.open("rb") as photo:
-            await context.bot.send_photo(chat_id=chat.id, photo=photo, caption=caption)
+        await _send_campaign_photo(context.bot, chat.id, image_path, caption)
         try:
             await update.message.delete()
         except Exception as delete_error:
@@ -727,15 +1061,25 @@ async def _send_oa_intro(update: Update, context: ContextTypes.DEFAULT_TYPE,
 # Authorized users (seen in AIS team chats) + preloaded env IDs
 team_user_ids: set[int] = set(PREAUTHORIZED_USER_IDS)
 
-# Track chats that had activity today (key: chat_id, value: YYYY-MM-DD)
-LAST_CHAT_ACTIVITY: Dict[str, str] = {}
+# Chats that had activity on TODAY_ACTIVE_DAY[0] (a CT date); cleared when the CT day rolls over
+TODAY_ACTIVE: Set[int] = set()
+TODAY_ACTIVE_DAY: List[Optional[date]] = [None]
+# Subset of TODAY_ACTIVE whose daily_group_activity row is written, and (CT date, chat_id) writes in flight
+TODAY_SAVED: Set[int] = set()
+TODAY_SAVING: Set[Tuple[date, int]] = set()
 
 # Once-per-day closed messages, tracked separately for AM(before shift) and PM(after shift)
-CLOSED_SENT_TODAY_AM: Dict[str, str] = {}  # group chat_id -> YYYY-MM-DD
-CLOSED_SENT_TODAY_PM: Dict[str, str] = {}  # group chat_id -> YYYY-MM-DD
+CLOSED_SENT_TODAY_AM: Dict[int, date] = {}  # group chat_id -> CT date it was sent
+CLOSED_SENT_TODAY_PM: Dict[int, date] = {}  # group chat_id -> CT date it was sent
 
 # Track last authorized message timestamp per chat (CT)
-LAST_AUTH_MSG_AT: Dict[str, datetime] = {}
+LAST_AUTH_MSG_AT: Dict[int, datetime] = {}
+
+# Chats whose CLOSED_SENT_TODAY_*/LAST_AUTH_MSG_AT entries changed since the last chat_spiel_state flush
+SPIEL_STATE_DIRTY: Set[int] = set()
+# [True] when pending flood buffers changed since the last pending_prompts flush
+PENDING_PROMPTS_DIRTY: List[bool] = [False]
+SPIEL_STATE_FLUSH_SECONDS = 10
 
 # Flood buffer inactivity window
 FLOOD_BUFFER_SECONDS = 5 * 60  # 5 minutes
@@ -743,89 +1087,185 @@ FLOOD_BUFFER_SECONDS = 5 * 60  # 5 minutes
 # After-hours suppression window when an authorized user posts (2h), and 1h threshold to allow spiel if non-auth messages
 AFTER_HOURS_SUPPRESSION_WINDOW_HOURS = 2
 AFTER_HOURS_MIN_SILENCE_FOR_SPIEL_HOURS = 1
+# Same windows in seconds, so age checks compare floats instead of building timedeltas per message
+AFTER_HOURS_SUPPRESSION_WINDOW_SEC = AFTER_HOURS_SUPPRESSION_WINDOW_HOURS * 3600
+AFTER_HOURS_MIN_SILENCE_FOR_SPIEL_SEC = AFTER_HOURS_MIN_SILENCE_FOR_SPIEL_HOURS * 3600
 
-# --------------- Debounce tokens & task registry ---------------
+# --------------- Flood-buffer timers (one worker + min-heap) ---------------
 # We key by (chat_id, period) where period in {"AM","PM","WE","LUNCH","CUTOFF"}
-DEBOUNCE_TOKEN: Dict[Tuple[str, str], str] = {}
-PENDING_TASK: Dict[Tuple[str, str], asyncio.Task] = {}
+# Monotonic deadline per pending key; rapid messages slide it instead of creating timers
+FLOOD_DEADLINE: Dict[Tuple[int, str], float] = {}
+# Sequence number of each pending key's live heap entry; entries with any other seq are stale
+FLOOD_SEQ: Dict[Tuple[int, str], int] = {}
+# (deadline, seq, chat_id, period) — at most one live entry per key, re-pushed lazily when its deadline slid
+FLOOD_HEAP: List[Tuple[float, int, int, str]] = []
+FLOOD_WAKE: Optional[asyncio.Event] = None  # created with the worker, inside the running loop
+_FLOOD_SEQ_COUNTER = count()
+_FLOOD_WORKER: Optional[asyncio.Task] = None
+# Strong references to fired prompt sends (and the fallback Last Call timer) so they are not garbage-collected mid-flight
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
 
 # ---------------- Helpers ----------------
 def now_in_timezone():
     return datetime.now(TIMEZONE)
 
-def is_weekend():
-    return now_in_timezone().weekday() >= 5
-
-def is_office_open():
-    now = now_in_timezone()
-    if is_weekend():
+# [date, "YYYY-MM-DD"] for the last day formatted, so strftime runs once per day instead of per message
+_DAY_STR_CACHE: List[Any] = [None, ""]
+
+def day_str(now: Optional[datetime] = None) -> str:
+    """Return the CT calendar day of `now` (default: current time) as YYYY-MM-DD."""
+    now = now or now_in_timezone()
+    day = now.date()
+    if _DAY_STR_CACHE[0] != day:
+        _DAY_STR_CACHE[0] = day
+        _DAY_STR_CACHE[1] = now.strftime("%Y-%m-%d")
+    return _DAY_STR_CACHE[1]
+
+# The clock helpers accept the caller's `now` so one update computes the current time only once.
+def is_weekend(now: Optional[datetime] = None):
+    return (now or now_in_timezone()).weekday() >= 5
+
+def is_office_open(now: Optional[datetime] = None):
+    now = now or now_in_timezone()
+    if is_weekend(now):
         return False, False
-    t = now.time()
-    open_ = WEEKDAY_START <= t <= WEEKDAY_END
-    before_cutoff = t <= WEEKDAY_CUTOFF
+    m = now.hour * 60 + now.minute
+    open_ = WEEKDAY_START_MIN <= m < WEEKDAY_END_MIN
+    before_cutoff = m < WEEKDAY_CUTOFF_MIN
     return open_, before_cutoff
 
-def is_lunch_time():
-    t = now_in_timezone().time()
-    return LUNCH_START <= t <= LUNCH_END
+def is_lunch_time(now: Optional[datetime] = None):
+    now = now or now_in_timezone()
+    return LUNCH_START_MIN <= now.hour * 60 + now.minute < LUNCH_END_MIN
+
+class OfficeState(Enum):
+    """Office-hours state of a moment in CT; the value is the spiel period it buffers (if any)."""
+    OPEN = "OPEN"
+    LUNCH = "LUNCH"
+    CUTOFF = "CUTOFF"
+    CLOSED_AM = "AM"
+    CLOSED_PM = "PM"
+    WEEKEND = "WE"
+
+def office_state(now: Optional[datetime] = None) -> OfficeState:
+    """Classify `now` in a single pass, with the same boundaries as the is_* helpers above."""
+    now = now or now_in_timezone()
+    if now.weekday() >= 5:
+        return OfficeState.WEEKEND
+    m = now.hour * 60 + now.minute
+    if LUNCH_START_MIN <= m < LUNCH_END_MIN:
+        return OfficeState.LUNCH
+    if m < WEEKDAY_START_MIN:
+        return OfficeState.CLOSED_AM
+    if m >= WEEKDAY_END_MIN:
+        return OfficeState.CLOSED_PM
+    return OfficeState.OPEN if m < WEEKDAY_CUTOFF_MIN else OfficeState.CUTOFF
 
 def is_authorized_user(user_id: int) -> bool:
-    return (user_id in team_user_ids) or (user_id in PREAUTHORIZED_USER_IDS)
+    # team_user_ids is seeded with PREAUTHORIZED_USER_IDS and only ever grows, so one lookup covers both.
+    return user_id in team_user_ids
 
-def maybe_record_team_member(update: Update):
-    chat_id = str(update.effective_chat.id)
-    user = update.effective_user
-    if chat_id in AIS_TEAM_CHAT_IDS and user:
-        if user.id not in team_user_ids:
-            logger.info(f"[AIS TEAM] New authorized member from {chat_id}: {user.full_name} (ID: {user.id})")
+def maybe_record_team_member(chat, user):
+    """Authorize anyone who speaks in an AIS team chat; callers pass the update's resolved chat/user."""
+    # Fast path: almost every update comes from a customer group, never a team chat.
+    if not chat or chat.id not in AIS_TEAM_CHAT_IDS:
+        return
+    if user and user.id not in team_user_ids:
+        logger.info(f"[AIS TEAM] New authorized member from {chat.id}: {user.full_name} (ID: {user.id})")
         team_user_ids.add(user.id)
 
-def record_message_for_transcript(update: Update):
-    chat = update.effective_chat
-    msg = update.effective_message
+def _transcript_buffer(chat_id: int) -> deque:
+    """Return (creating if needed) the chat's transcript deque and mark the chat most recently used."""
+    buf = chat_buffers.get(chat_id)
+    if buf is None:
+        if len(chat_buffers) >= TRANSCRIPT_MAX_CHATS:
+            chat_buffers.popitem(last=False)
+        buf = chat_buffers[chat_id] = deque(maxlen=TRANSCRIPT_MAX_MESSAGES)
+    else:
+        chat_buffers.move_to_end(chat_id)
+    return buf
+
+def _transcript_ts(ts: datetime) -> str:
+    """Format as "YYYY-MM-DD hh:mm AM/PM" with plain int formatting (same output as strftime("%Y-%m-%d %I:%M %p"))."""
+    return (f"{ts.year:04d}-{ts.month:02d}-{ts.day:02d} "
+            f"{(ts.hour - 1) % 12 + 1:02d}:{ts.minute:02d} {'AM' if ts.hour < 12 else 'PM'}")
+
+def record_message_for_transcript(chat, user, msg):
     if not chat or not msg:
         return
     txt = msg.text or msg.caption
     if not txt:
         return
-    chat_id = str(chat.id)
-    entry = {
-        "ts": datetime.fromtimestamp(msg.date.timestamp(), tz=TIMEZONE).strftime("%Y-%m-%d %I:%M %p"),
-        "name": (update.effective_user.full_name or update.effective_user.username or str(update.effective_user.id))[:80],
-        "text": (txt or "").strip()
-    }
-    chat_buffers[chat_id].append(entry)
+    chat_id = chat.id
+    entry = TranscriptEntry(
+        ts=_transcript_ts(msg.date.astimezone(TIMEZONE)),
+        name=(user.full_name or user.username or str(user.id))[:80],
+        text=(txt or "").strip(),
+    )
+    _transcript_buffer(chat_id).append(entry)
 
 # ---- Email via SendGrid HTTPS API ----
+_EMAIL_EXECUTOR = ThreadPoolExecutor(max_workers=EMAIL_MAX_WORKERS, thread_name_prefix="email")
+_SENDGRID_CLIENT: Optional[httpx.Client] = None
+_SENDGRID_CLIENT_LOCK = threading.Lock()
+
+def _sendgrid_client() -> httpx.Client:
+    """Lazily create one keep-alive SendGrid client shared by all send threads (TLS is reused)."""
+    global _SENDGRID_CLIENT
+    if _SENDGRID_CLIENT is None:
+        with _SENDGRID_CLIENT_LOCK:
+            if _SENDGRID_CLIENT is None:
+                _SENDGRID_CLIENT = httpx.Client(
+                    base_url="https://api.sendgrid.com",
+                    headers={
+                        "Authorization": f"Bearer {SENDGRID_API_KEY}",
+                        "Content-Type": "application/json",
+                    },
+                    timeout=30.0,
+                    # One pooled keep-alive connection per email worker; idle sockets are recycled before
+                    # SendGrid's side drops them, so a send rarely pays for a fresh TLS handshake.
+                    limits=httpx.Limits(
+                        max_connections=EMAIL_MAX_WORKERS,
+                        max_keepalive_connections=EMAIL_MAX_WORKERS,
+                        keepalive_expiry=60.0,
+                    ),
+                )
+    return _SENDGRID_CLIENT
+
+def close_email_clients() -> None:
+    """Drop queued sends without waiting on in-flight ones (or their 429 backoff), then close the SendGrid pool."""
+    global _SENDGRID_CLIENT
+    _EMAIL_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    with _SENDGRID_CLIENT_LOCK:
+        if _SENDGRID_CLIENT is not None:
+            _SENDGRID_CLIENT.close()
+            _SENDGRID_CLIENT = None
+
 def _send_email_sendgrid(subject: str, body: str, to_addr: str,
                          attach_name: Optional[str] = None, attach_bytes: Optional[bytes] = None) -> tuple[bool, Optional[str]]:
     """
-    Sends email via SendGrid API (HTTPS).
+    Sends email via SendGrid API (HTTPS). Assumes EMAIL_CONFIG_ERROR is None.
     Returns (ok, error_message_if_any).
     """
-    api_key = SENDGRID_API_KEY
-    if not api_key:
-        return False, "Missing SENDGRID_API_KEY"
-    from_email = FROM_EMAIL
-    if not from_email:
-        return False, "Missing FROM_EMAIL"
-
     data = {
         "personalizations": [{"to": [{"email": to_addr}]}],
-        "from": {"email": from_email},
+        "from": {"email": FROM_EMAIL},
         "subject": subject or "",
         "content": [{"type": "text/plain", "value": body or ""}],
     }
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-
     try:
-        r = httpx.post("https://api.sendgrid.com/v3/mail/send", headers=headers, json=data, timeout=30.0)
-        if r.status_code == 202:
-            return True, None
+        for attempt in range(EMAIL_MAX_RETRIES + 1):
+            r = _sendgrid_client().post("/v3/mail/send", json=data)
+            if r.status_code == 202:
+                return True, None
+            if r.status_code != 429 or attempt == EMAIL_MAX_RETRIES:
+                break
+            retry_after = r.headers.get("Retry-After", "")
+            delay = min(float(retry_after) if retry_after.isdigit() else 2 ** attempt, 30.0)
+            logger.warning(f"SendGrid rate limited (429); retrying in {delay:.0f}s")
+            import time  # the module-level `time` is datetime.time
+            time.sleep(delay)  # runs on an email worker thread, never on the event loop
         return False, f"SendGrid error {r.status_code}: {r.text}"
     except Exception as e:
         logger.exception("SendGrid send failed")
@@ -836,6 +1276,8 @@ async def send_email_async(subject: str, body: str, to_addr: Optional[str] = Non
     """
     Async wrapper to send via SendGrid. Keeps the same signature used elsewhere.
     """
+    if EMAIL_CONFIG_ERROR:
+        return False, EMAIL_CONFIG_ERROR
     def _send():
         return _send_email_sendgrid(
             subject=subject,
@@ -844,201 +1286,233 @@ async def send_email_async(subject: str, body: str, to_addr: Optional[str] = Non
             attach_name=attach_name,
             attach_bytes=attach_bytes
         )
-    return await asyncio.to_thread(_send)
+    # Bursts queue (FIFO) on the email pool instead of occupying the loop's default executor.
+    return await asyncio.get_running_loop().run_in_executor(_EMAIL_EXECUTOR, _send)
 
 # ---- Transcript rendering (kept for future image use; now we send text emails) ----
 def render_transcript_image(chat_title: str, entries: deque) -> Optional[bytes]:
     return None  # explicitly disabled; we now email plain text
 
 # ---------------- Debounce helpers ----------------
-def _period_key(chat_id: str, period: str) -> Tuple[str, str]:
+def _period_key(chat_id: int, period: str) -> Tuple[int, str]:
     return (chat_id, period)
 
-def _new_token() -> str:
-    return now_in_timezone().isoformat()
-
-def _set_debounce(chat_id: str, period: str) -> str:
-    key = _period_key(chat_id, period)
-    token = _new_token()
-    DEBOUNCE_TOKEN[key] = token
-    task = PENDING_TASK.pop(key, None)
-    if task and not task.done():
-        task.cancel()
-    return token
-
-def _is_latest_token(chat_id: str, period: str, token: str) -> bool:
-    return DEBOUNCE_TOKEN.get(_period_key(chat_id, period)) == token
-
-def _clear_debounce(chat_id: str, period: str):
-    key = _period_key(chat_id, period)
-    PENDING_TASK.pop(key, None)
-
-def cancel_all_pending_for_chat(chat_id: str):
+def cancel_all_pending_for_chat(chat_id: int):
     """Cancel ALL pending buffered prompts for this chat (AM/PM/WE/LUNCH/CUTOFF)."""
     for period in ("AM", "PM", "WE", "LUNCH", "CUTOFF"):
         key = _period_key(chat_id, period)
-        task = PENDING_TASK.pop(key, None)
-        if task and not task.done():
-            task.cancel()
-        DEBOUNCE_TOKEN[key] = _new_token()
+        # Dropping the seq turns the key's heap entry stale; the worker discards it when it surfaces.
+        if FLOOD_SEQ.pop(key, None) is not None:
+            PENDING_PROMPTS_DIRTY[0] = True
+        FLOOD_DEADLINE.pop(key, None)
+
+def _spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
 
 # ---------------- Authorization + cooldown helpers ----------------
 def require_authorized(func):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        maybe_record_team_member(update)
         user = update.effective_user
+        maybe_record_team_member(update.effective_chat, user)
         if not user or not is_authorized_user(user.id):
             await update.message.reply_text("Not authorized.")
             return
         return await func(update, context)
     return wrapper
 
-def already_sent(chat_id: str, tag: str, window_sec: int = 7200) -> bool:  # 2-hour cooldown per group
-    last = chat_last_response.get(chat_id, {})
-    when = last.get(tag)
-    if not when:
-        return False
-    try:
-        delta = now_in_timezone() - datetime.fromisoformat(when)
-        return delta.total_seconds() < window_sec
-    except Exception:
-        return False
+def already_sent(chat_id: int, tag: str, window_sec: int = 7200) -> bool:  # 2-hour cooldown per group
+    when = chat_last_response.get((chat_id, tag))
+    return when is not None and (monotonic() - when) < window_sec
 
-def mark_sent(chat_id: str, tag: str):
-    chat_last_response.setdefault(chat_id, {})[tag] = now_in_timezone().isoformat()
+def mark_sent(chat_id: int, tag: str):
+    chat_last_response[(chat_id, tag)] = monotonic()
 
-def set_last_auth_msg(chat_id: str):
-    LAST_AUTH_MSG_AT[chat_id] = now_in_timezone()
+def set_last_auth_msg(chat_id: int, now: Optional[datetime] = None):
+    LAST_AUTH_MSG_AT[chat_id] = now or now_in_timezone()
+    SPIEL_STATE_DIRTY.add(chat_id)
 
-def last_auth_msg_age(chat_id: str) -> Optional[timedelta]:
+def last_auth_msg_age(chat_id: int, now: Optional[datetime] = None) -> Optional[float]:
+    """Seconds since the last authorized message in this chat, or None if there was none."""
     ts = LAST_AUTH_MSG_AT.get(chat_id)
     if not ts:
         return None
-    return now_in_timezone() - ts
+    return ((now or now_in_timezone()) - ts).total_seconds()
 
-def within_after_hours_suppression(chat_id: str) -> bool:
+def within_after_hours_suppression(chat_id: int, now: Optional[datetime] = None) -> bool:
     """Outside business hours (incl. weekends) AND within 2h since last authorized message in this chat."""
-    open_, _ = is_office_open()
+    now = now or now_in_timezone()
+    open_, _ = is_office_open(now)
     if open_:
         return False
-    age = last_auth_msg_age(chat_id)
+    age = last_auth_msg_age(chat_id, now)
     if age is None:
         return False
-    return age <= timedelta(hours=AFTER_HOURS_SUPPRESSION_WINDOW_HOURS)
+    return age <= AFTER_HOURS_SUPPRESSION_WINDOW_SEC
 
-def allow_after_hours_spiel(chat_id: str) -> bool:
+def allow_after_hours_spiel(chat_id: int, now: Optional[datetime] = None) -> bool:
     """Outside hours: if within 2h suppression, allow only after 1h silence; else allow."""
-    open_, _ = is_office_open()
+    now = now or now_in_timezone()
+    open_, _ = is_office_open(now)
     if open_:
         return False
-    age = last_auth_msg_age(chat_id)
+    age = last_auth_msg_age(chat_id, now)
     if age is None:
         return True
-    if age >= timedelta(hours=AFTER_HOURS_SUPPRESSION_WINDOW_HOURS):
+    if age >= AFTER_HOURS_SUPPRESSION_WINDOW_SEC:
         return True
-    return age >= timedelta(hours=AFTER_HOURS_MIN_SILENCE_FOR_SPIEL_HOURS)
+    return age >= AFTER_HOURS_MIN_SILENCE_FOR_SPIEL_SEC
 
 # --------------- Buffered scheduling for all prompts ---------------
-async def _buffer_then_send(chat_id: str, period: str, token: str, context: ContextTypes.DEFAULT_TYPE):
-    """period in {"AM","PM","WE","LUNCH","CUTOFF"}"""
-    try:
-        await asyncio.sleep(FLOOD_BUFFER_SECONDS)
-        if not _is_latest_token(chat_id, period, token):
-            return
+_CLOSED_STATES = frozenset({OfficeState.CLOSED_AM, OfficeState.CLOSED_PM, OfficeState.WEEKEND})
+
+# Office states in which an expired buffer of each period may still send its prompt
+_PERIOD_SEND_STATES: Dict[str, FrozenSet[OfficeState]] = {
+    "AM": _CLOSED_STATES,
+    "PM": _CLOSED_STATES,
+    "WE": frozenset({OfficeState.WEEKEND}),
+    "LUNCH": frozenset({OfficeState.LUNCH}),
+    "CUTOFF": frozenset({OfficeState.CUTOFF}),
+}
+
+# Closed-hours spiels (at most once per CT day per chat): period -> (text, sent-today map)
+_CLOSED_PROMPTS: Dict[str, Tuple[str, Dict[int, date]]] = {
+    "AM": (CLOSED_MESSAGE_AM, CLOSED_SENT_TODAY_AM),
+    "PM": (CLOSED_MESSAGE_PM, CLOSED_SENT_TODAY_PM),
+}
 
+async def _send_buffered_prompt(bot, chat_id: int, period: str):
+    """Send the prompt for an expired flood buffer. period in {"AM","PM","WE","LUNCH","CUTOFF"}"""
+    try:
         now_local = now_in_timezone()
-        # Window checks & sending
-        if period == "AM":
-            open_, _ = is_office_open()
-            if open_:
-                return
-            if chat_id not in known_group_chats:
-                return
-            if CLOSED_SENT_TODAY_AM.get(chat_id) == now_local.strftime("%Y-%m-%d"):
-                return
-            if within_after_hours_suppression(chat_id) and not allow_after_hours_spiel(chat_id):
-                return
-            await context.bot.send_message(chat_id=int(chat_id), text=CLOSED_MESSAGE_AM)
-            CLOSED_SENT_TODAY_AM[chat_id] = now_local.strftime("%Y-%m-%d")
+        # One classification tells whether the period's window is still current
+        if office_state(now_local) not in _PERIOD_SEND_STATES[period]:
+            return
+        if chat_id not in known_group_chats:
             return
 
-        if period == "PM":
-            open_, _ = is_office_open()
-            if open_:
-                return
-            if chat_id not in known_group_chats:
+        closed = _CLOSED_PROMPTS.get(period)
+        if closed:
+            text, sent_today = closed
+            today = now_local.date()
+            if sent_today.get(chat_id) == today:
                 return
-            if CLOSED_SENT_TODAY_PM.get(chat_id) == now_local.strftime("%Y-%m-%d"):
+            if within_after_hours_suppression(chat_id, now_local) and not allow_after_hours_spiel(chat_id, now_local):
                 return
-            if within_after_hours_suppression(chat_id) and not allow_after_hours_spiel(chat_id):
-                return
-            await context.bot.send_message(chat_id=int(chat_id), text=CLOSED_MESSAGE_PM)
-            CLOSED_SENT_TODAY_PM[chat_id] = now_local.strftime("%Y-%m-%d")
+            await bot.send_message(chat_id=chat_id, text=text)
+            sent_today[chat_id] = today
+            SPIEL_STATE_DIRTY.add(chat_id)
             return
 
         if period == "WE":
-            if not is_weekend():
-                return
-            open_, _ = is_office_open()
-            if open_:
-                return
-            if chat_id not in known_group_chats:
-                return
-            if within_after_hours_suppression(chat_id) and not allow_after_hours_spiel(chat_id):
+            if within_after_hours_suppression(chat_id, now_local) and not allow_after_hours_spiel(chat_id, now_local):
                 return
             if not already_sent(chat_id, "weekend", window_sec=7200):
-                await context.bot.send_message(chat_id=int(chat_id), text=WEEKEND_MESSAGE)
+                await bot.send_message(chat_id=chat_id, text=WEEKEND_MESSAGE)
                 mark_sent(chat_id, "weekend")
             return
 
         if period == "LUNCH":
-            t = now_local.time()
-            if not (LUNCH_START <= t <= LUNCH_END):
-                return
-            if chat_id not in known_group_chats:
-                return
             if not already_sent(chat_id, "lunch"):
-                await context.bot.send_message(chat_id=int(chat_id), text=LUNCH_MESSAGE)
+                await bot.send_message(chat_id=chat_id, text=LUNCH_MESSAGE)
                 mark_sent(chat_id, "lunch")
             return
 
         if period == "CUTOFF":
-            t = now_local.time()
-            open_, before_cutoff = is_office_open()
-            if not open_ or t < WEEKDAY_CUTOFF or t > WEEKDAY_END:
-                return
-            if chat_id not in known_group_chats:
-                return
             # Suppress if an authorized user initiated on/before cutoff today
             ts = LAST_AUTH_MSG_AT.get(chat_id)
             if ts:
                 ts_local = ts.astimezone(TIMEZONE)
-                if ts_local.strftime("%Y-%m-%d") == now_local.strftime("%Y-%m-%d") and ts_local.time() <= WEEKDAY_CUTOFF:
+                if ts_local.date() == now_local.date() and ts_local.time() <= WEEKDAY_CUTOFF:
                     return
             if not already_sent(chat_id, "cutoff"):
-                await context.bot.send_message(chat_id=int(chat_id), text=AFTER_CUTOFF_MESSAGE, parse_mode="Markdown")
+                await bot.send_message(chat_id=chat_id, text=AFTER_CUTOFF_MESSAGE, parse_mode="Markdown")
                 mark_sent(chat_id, "cutoff")
             return
 
-    except asyncio.CancelledError:
-        pass
-    finally:
-        _clear_debounce(chat_id, period)
+    except Exception as e:
+        logger.error(f"Failed to send {period} prompt to {chat_id}: {e}")
 
-def schedule_buffered(chat_id: str, period: str, context: ContextTypes.DEFAULT_TYPE):
-    """Create/refresh a single timer using a debounce token so only the latest fires."""
-    token = _set_debounce(chat_id, period)
+async def _flood_worker(bot):
+    """Single timer for every flood buffer: sleep until the earliest deadline, then fire or re-queue it."""
+    while True:
+        if not FLOOD_HEAP:
+            FLOOD_WAKE.clear()
+            await FLOOD_WAKE.wait()
+            continue
+        deadline, seq, chat_id, period = FLOOD_HEAP[0]
+        delay = deadline - monotonic()
+        if delay > 0:
+            FLOOD_WAKE.clear()
+            try:
+                await asyncio.wait_for(FLOOD_WAKE.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        heapq.heappop(FLOOD_HEAP)
+        key = (chat_id, period)
+        if FLOOD_SEQ.get(key) != seq:
+            continue  # cancelled (or replaced) since it was queued
+        current = FLOOD_DEADLINE[key]
+        if current > deadline:
+            # Messages arrived meanwhile and slid the deadline: re-queue once instead of per message.
+            heapq.heappush(FLOOD_HEAP, (current, seq, chat_id, period))
+            continue
+        del FLOOD_SEQ[key]
+        del FLOOD_DEADLINE[key]
+        PENDING_PROMPTS_DIRTY[0] = True
+        _spawn_background(_send_buffered_prompt(bot, chat_id, period))
+
+
+def _ensure_flood_worker(bot) -> None:
+    global _FLOOD_WORKER, FLOOD_WAKE
+    if _FLOOD_WORKER is None or _FLOOD_WORKER.done():
+        FLOOD_WAKE = asyncio.Event()
+        _FLOOD_WORKER = asyncio.create_task(_flood_worker(bot))
+
+
+def _queue_buffered(chat_id: int, period: str, deadline: float) -> None:
     key = _period_key(chat_id, period)
-    PENDING_TASK[key] = asyncio.create_task(_buffer_then_send(chat_id, period, token, context))
+    if key not in FLOOD_SEQ:
+        seq = FLOOD_SEQ[key] = next(_FLOOD_SEQ_COUNTER)
+        entry = (deadline, seq, chat_id, period)
+        if not FLOOD_HEAP or entry < FLOOD_HEAP[0]:
+            FLOOD_WAKE.set()
+        heapq.heappush(FLOOD_HEAP, entry)
+    FLOOD_DEADLINE[key] = deadline
+    PENDING_PROMPTS_DIRTY[0] = True
+
+
+def schedule_buffered(chat_id: int, period: str, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Create/refresh the flood buffer for a chat + period.
+    A burst of customer messages only slides the key's deadline (O(1), no task per
+    message); one shared worker fires each buffer when its deadline passes.
+    """
+    _ensure_flood_worker(context.bot)
+    _queue_buffered(chat_id, period, monotonic() + FLOOD_BUFFER_SECONDS)
+
+
+def restore_pending_prompts(bot, pending: List[Tuple[int, str, datetime]]) -> None:
+    """Re-arm flood buffers pending at the last shutdown; overdue ones fire at once and re-check their window."""
+    if not pending:
+        return
+    _ensure_flood_worker(bot)
+    now, mono = now_in_timezone(), monotonic()
+    for chat_id, period, fire_at in pending:
+        _queue_buffered(chat_id, period, mono + max(0.0, (fire_at - now).total_seconds()))
+    logger.info(f"Re-armed {len(pending)} pending prompts from before the restart.")
 
 # ---------------- Commands (authorized-only) — NO COOLDOWN ----------------
 def require_and_record(func):
     @require_authorized
     async def inner(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        record_message_for_transcript(update)
         chat = update.effective_chat
-        if chat and chat.type in (Chat.GROUP, Chat.SUPERGROUP):
-            await mark_daily_activity(str(chat.id))
+        record_message_for_transcript(chat, update.effective_user, update.effective_message)
+        if chat and chat.type in GROUP_CHAT_TYPES:
+            await mark_daily_activity(chat.id)
         return await func(update, context)
     return inner
 
@@ -1108,15 +1582,9 @@ async def _asp_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(f"No ASP {label} groups saved yet.")
         return
 
-    ok = 0
-    fail = 0
-    for cid in targets:
-        try:
-            await context.bot.send_message(chat_id=cid, text=text_to_send)
-            ok += 1
-        except Exception as e:
-            fail += 1
-            logger.error(f"/{command_name} failed for chat {cid}: {e}")
+    ok, fail = await _fan_out(
+        targets, lambda cid: context.bot.send_message(chat_id=cid, text=text_to_send), f"/{command_name}"
+    )
 
     label = language or "ALL"
     await update.message.reply_text(
@@ -1147,36 +1615,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @require_and_record
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "🤖 Available commands (AIS TEAM only):\n"
-        "/start – Welcome\n"
-        "/help – This list\n"
-        "/myid – Your chat ID\n"
-        "/rules – Send & pin rules\n"
-        "/lt /apd /mvr /sign /emails – Quick replies\n"
-        "/time /hours – Business hours\n"
-        "/coi – COI instructions\n"
-        "/ssi – Email transcript to info@\n"
-        "/sse – Email transcript to endorsements@\n"
-        "/ssc – Email transcript to coi@\n"
-        "/who – List known groups (title + ID)\n"
-        "/broadcast – Send one-time announcement to all groups\n"
-        "/broadcastexcept – Send a photo + caption to all groups except the permanent exclusion list\n"
-        "/broadcastpin – Broadcast and try to pin in all groups\n"
-        "/broadcastto – Targeted broadcast to specific group(s) by ID or name\n"
-        "/ASPE – Send English ASP introduction + save group to ASP EN list\n"
-        "/ASPR – Send Russian ASP introduction + save group to ASP RU list\n"
-        "/OAE – Send the English Occupational Accident image and text\n"
-        "/aspcount – Show ASP English/Russian/unique group counts\n"
-        "/aspwho – List saved ASP groups in safe chunks\n"
-        "/aspbroadcaste – Broadcast text to ASP English groups only\n"
-        "/aspbroadcastr – Broadcast text to ASP Russian groups only\n"
-        "/aspbroadcast – Broadcast text to all unique ASP groups\n"
-        "/refreshtitles – Recover/update names from Telegram\n"
-        "/findgroup – Search company name and show chat IDs\n"
-        "/exportgroups – Download all names and IDs as CSV\n"
-        "/matchinsured – Match insured list and export chat IDs"
-    )
+    await update.message.reply_text(HELP_MESSAGE)
 
 @require_and_record
 async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1190,30 +1629,69 @@ async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.warning(f"Unable to pin rules in chat {update.effective_chat.id}: {e}")
 
+def _command_name(message) -> str:
+    """Lowercased command name (no slash, no @botname) from Telegram's own bot_command entity."""
+    text = message.text or ""
+    for ent in message.entities or ():
+        if ent.type == "bot_command" and ent.offset == 0:
+            return text[1:ent.length].split("@", 1)[0].lower()
+    return ""
+
 @require_and_record
 async def generic_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = str(update.effective_chat.id)
-    cmd = (update.message.text or "").split()[0].lstrip("/").lower()
-    if cmd in COMMAND_MESSAGES:
-        await update.message.reply_text(COMMAND_MESSAGES[cmd], parse_mode="Markdown")
+    chat_id = update.effective_chat.id
+    cmd = _command_name(update.message)
+    reply = COMMAND_MESSAGES.get(cmd)
+    if reply:
+        # Sent inline: this handler already runs in per-chat order, so replies keep command order.
+        text, parse_mode = reply
+        await update.message.reply_text(text, parse_mode=parse_mode)
     set_last_auth_msg(chat_id)
     cancel_all_pending_for_chat(chat_id)
 
 @require_and_record
 async def time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "🕒 *Business Hours (CT)*\n"
-        "Mon–Fri: 9:00 AM – 5:00 PM\n"
-        "Lunch: 12:30 PM – 1:30 PM\n"
-        "Weekends: Closed",
-        parse_mode="Markdown"
-    )
+    await update.message.reply_text(BUSINESS_HOURS_MESSAGE, parse_mode="Markdown")
 
 @require_and_record
 async def coi_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(COI_TEXT, parse_mode="Markdown")
 
 # ---------- Broadcast helpers ----------
+async def _fan_out(targets, send_one, label: str) -> Tuple[int, int]:
+    """
+    Await send_one(chat_id) for every target, FANOUT_CONCURRENCY at a time; returns (ok, failed).
+    Each chat gets its own message, so overlapping the round-trips cannot reorder anything,
+    and the rate limiter still paces the actual requests to Telegram's limits. Without a rate
+    limiter, sends go one at a time, UNTHROTTLED_SEND_INTERVAL apart.
+    """
+    sem = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def _one(chat_id: int) -> bool:
+        async with sem:
+            try:
+                await send_one(chat_id)
+                return True
+            except Exception as e:
+                logger.error(f"{label} failed for chat {chat_id}: {e}")
+                return False
+
+    if not OUTBOUND_RATE_LIMITED:
+        # Nothing paces the requests for us: one send at a time with fixed spacing, as before the limiter.
+        ok = total = 0
+        for cid in targets:
+            ok += await _one(cid)
+            total += 1
+            await asyncio.sleep(UNTHROTTLED_SEND_INTERVAL)
+        return ok, total - ok
+
+    results = await asyncio.gather(*(_one(cid) for cid in targets))
+    ok = sum(results)
+    return ok, len(results) - ok
+
+# "Group Name" targets in /broadcastto arguments
+_QUOTED_NAME_RE = re.compile(r'"([^"]+)"')
+
 def _find_targets_by_names_or_ids(targets_raw: str) -> Tuple[List[int], List[str]]:
     """
     Parse targets: either comma-separated IDs, or quoted names (partial match).
@@ -1227,12 +1705,12 @@ def _find_targets_by_names_or_ids(targets_raw: str) -> Tuple[List[int], List[str
     chat_ids: List[int] = []
 
     # Look for quoted names
-    names = re.findall(r'"([^"]+)"', targets_raw)
+    names = _QUOTED_NAME_RE.findall(targets_raw)
     if names:
         lowered = {cid: (meta.get("title") or "").lower() for cid, meta in known_group_chats.items()}
         for name in names:
             name_l = name.strip().lower()
-            matched = [int(cid) for cid, ttl in lowered.items() if name_l in ttl]
+            matched = [cid for cid, ttl in lowered.items() if name_l in ttl]
             if not matched:
                 errors.append(f'No group matched name "{name}"')
             else:
@@ -1282,17 +1760,9 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage:\n/broadcast Your announcement text")
         return
     text = msg[1].strip()
-    total = 0
-    ok = 0
-    fail = 0
-    for cid in list(known_group_chats.keys()):
-        try:
-            await context.bot.send_message(chat_id=int(cid), text=text)
-            ok += 1
-        except Exception as e:
-            fail += 1
-            logger.error(f"/broadcast failed for chat {cid}: {e}")
-        total += 1
+    targets = list(known_group_chats.keys())
+    total = len(targets)
+    ok, fail = await _fan_out(targets, lambda cid: context.bot.send_message(chat_id=cid, text=text), "/broadcast")
     await update.message.reply_text(f"📣 Broadcast sent.\n✅ {ok} succeeded • ❌ {fail} failed • 📦 {total} groups total.")
 
 def _broadcast_command_text(update: Update) -> str:
@@ -1316,11 +1786,10 @@ def _broadcast_photo_file_id(update: Update) -> Optional[str]:
     return None
 
 
-def _suppress_auto_spiels_after_staff_broadcast(chat_id: str) -> None:
+def _suppress_auto_spiels_after_staff_broadcast(chat_id: int) -> None:
     """Treat a successful staff broadcast as authorized activity in the recipient group."""
-    cid = str(chat_id)
-    set_last_auth_msg(cid)
-    cancel_all_pending_for_chat(cid)
+    set_last_auth_msg(chat_id)
+    cancel_all_pending_for_chat(chat_id)
 
 
 @require_and_record
@@ -1349,21 +1818,12 @@ async def broadcastexcept_command(update: Update, context: ContextTypes.DEFAULT_
     all_ids = list(known_group_chats.keys())
     targets = [cid for cid in all_ids if cid not in exclusions]
     excluded_saved = sum(1 for cid in all_ids if cid in exclusions)
-    ok = fail = 0
 
-    for cid in targets:
-        try:
-            await context.bot.send_photo(
-                chat_id=int(cid),
-                photo=photo_file_id,
-                caption=text,
-            )
-            _suppress_auto_spiels_after_staff_broadcast(cid)
-            ok += 1
-            await asyncio.sleep(0.12)
-        except Exception as e:
-            fail += 1
-            logger.error(f"/broadcastexcept failed for chat {cid}: {e}")
+    async def _send(cid: int) -> None:
+        await context.bot.send_photo(chat_id=cid, photo=photo_file_id, caption=text)
+        _suppress_auto_spiels_after_staff_broadcast(cid)
+
+    ok, fail = await _fan_out(targets, _send, "/broadcastexcept")
 
     await update.effective_message.reply_text(
         "📣 Broadcast-except complete.\n"
@@ -1382,21 +1842,17 @@ async def broadcastpin_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Usage:\n/broadcastpin Your announcement text")
         return
     text = msg[1].strip()
-    total = 0
-    ok = 0
-    fail = 0
-    for cid in list(known_group_chats.keys()):
+
+    async def _send_and_pin(cid: int) -> None:
+        sent = await context.bot.send_message(chat_id=cid, text=text)
         try:
-            sent = await context.bot.send_message(chat_id=int(cid), text=text)
-            try:
-                await context.bot.pin_chat_message(chat_id=int(cid), message_id=sent.message_id, disable_notification=True)
-            except Exception as pe:
-                logger.warning(f"/broadcastpin: pin failed for {cid}: {pe}")
-            ok += 1
-        except Exception as e:
-            fail += 1
-            logger.error(f"/broadcastpin failed for chat {cid}: {e}")
-        total += 1
+            await context.bot.pin_chat_message(chat_id=cid, message_id=sent.message_id, disable_notification=True)
+        except Exception as pe:
+            logger.warning(f"/broadcastpin: pin failed for {cid}: {pe}")
+
+    targets = list(known_group_chats.keys())
+    total = len(targets)
+    ok, fail = await _fan_out(targets, _send_and_pin, "/broadcastpin")
     await update.message.reply_text(f"📌 Broadcast (pinned) done.\n✅ {ok} succeeded • ❌ {fail} failed • 📦 {total} groups total.")
 
 @require_and_record
@@ -1421,7 +1877,7 @@ async def broadcastto_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     arg = parts[1].strip()
 
     # If we have quoted names, message starts after the last closing quote
-    quoted_names = re.findall(r'"([^"]+)"', arg)
+    quoted_names = _QUOTED_NAME_RE.findall(arg)
     if quoted_names:
         last_quote = arg.rfind('"')
         msg_text = arg[last_quote+1:].strip().lstrip(",").strip()
@@ -1446,25 +1902,27 @@ async def broadcastto_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Please provide a message to send.")
         return
 
-    ok = 0
-    fail = 0
-    for cid in targets_ids:
-        try:
-            await context.bot.send_message(chat_id=int(cid), text=msg_text)
-            ok += 1
-        except Exception as e:
-            fail += 1
-            logger.error(f"/broadcastto failed for chat {cid}: {e}")
+    ok, fail = await _fan_out(
+        targets_ids, lambda cid: context.bot.send_message(chat_id=cid, text=msg_text), "/broadcastto"
+    )
 
     await update.message.reply_text(f"🎯 Targeted broadcast sent.\n✅ {ok} succeeded • ❌ {fail} failed • 🎯 {len(targets_ids)} groups targeted.")
 
 
+# Filler words stripped before fuzzy company matching (one alternation = one scan per name)
+_COMPANY_NOISE_RE = re.compile(
+    r"\b(?:insurance|ais|apd|fleet|sitor|general|chat|group"
+    r"|incorporated|corporation|company|limited liability company"
+    r"|inc|llc|corp|co|ltd)\b"
+)
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+
+@lru_cache(maxsize=4096)
 def _normalize_company_name(value: str) -> str:
     value = (value or "").lower().replace("&", " and ")
-    value = re.sub(r"\b(insurance|ais|apd|fleet|sitor|general|chat|group)\b", " ", value)
-    value = re.sub(r"\b(incorporated|corporation|company|limited liability company)\b", " ", value)
-    value = re.sub(r"\b(inc|llc|corp|co|ltd)\b", " ", value)
-    value = re.sub(r"[^a-z0-9]+", " ", value)
+    value = _COMPANY_NOISE_RE.sub(" ", value)
+    value = _NON_ALNUM_RE.sub(" ", value)
     return " ".join(value.split())
 
 
@@ -1490,41 +1948,52 @@ async def refreshtitles_command(update: Update, context: ContextTypes.DEFAULT_TY
     progress = await update.message.reply_text(
         f"🔄 Refreshing titles for {total} saved groups. This may take several minutes..."
     )
-    updated = unchanged = unavailable = processed = 0
+    changes: Dict[int, str] = {}  # chat_id -> new title, applied once after every lookup is done
+    unchanged = unavailable = 0
 
-    for cid in list(known_group_chats.keys()):
+    async def _refresh(cid: int) -> None:
+        nonlocal unchanged, unavailable
         try:
-            chat = await context.bot.get_chat(int(cid))
+            chat = await context.bot.get_chat(cid)
             title = chat.title or ""
             old_title = known_group_chats.get(cid, {}).get("title") or ""
             if title and title != old_title:
-                await persist_known_group(cid, title)
-                updated += 1
+                changes[cid] = title
             else:
                 unchanged += 1
         except Exception as e:
             unavailable += 1
             logger.warning(f"/refreshtitles could not access {cid}: {e}")
 
-        processed += 1
-        if processed % 25 == 0:
+    # Batches of REFRESH_PROGRESS_EVERY: lookups within a batch overlap, progress is edited once per batch.
+    targets = list(known_group_chats.keys())
+    for start in range(0, total, REFRESH_PROGRESS_EVERY):
+        # _refresh handles its own failures, so _fan_out's tally is not needed here.
+        await _fan_out(targets[start:start + REFRESH_PROGRESS_EVERY], _refresh, "/refreshtitles")
+        processed = min(start + REFRESH_PROGRESS_EVERY, total)
+        if processed < total:
             try:
                 await progress.edit_text(
                     f"🔄 Refreshing group titles...\n"
                     f"Processed: {processed}/{total}\n"
-                    f"✅ Updated: {updated}\n"
+                    f"✅ Updated: {len(changes)}\n"
                     f"➖ Unchanged: {unchanged}\n"
                     f"❌ Unavailable: {unavailable}"
                 )
             except Exception:
                 pass
-        await asyncio.sleep(0.08)
 
-    save_known_groups_to_json()
+    # One JSON rewrite for the whole run instead of one per renamed group.
+    now_iso = now_in_timezone().isoformat()
+    for cid, title in changes.items():
+        merge_known_group(cid, title=title, last_seen=now_iso)
+        await save_group_to_db(cid, title)
+    if changes:
+        save_known_groups_to_json()
     await progress.edit_text(
         f"✅ Title refresh complete\n\n"
         f"📦 Total checked: {total}\n"
-        f"✅ Names updated: {updated}\n"
+        f"✅ Names updated: {len(changes)}\n"
         f"➖ Already current: {unchanged}\n"
         f"❌ Bot could not access: {unavailable}"
     )
@@ -1652,19 +2121,16 @@ async def matchinsured_command(update: Update, context: ContextTypes.DEFAULT_TYP
 # ---- Transcript emailers (plain text; subject = group title only) ----
 async def _send_transcript_email(update: Update, to_addr: str):
     chat = update.effective_chat
-    chat_id = str(chat.id)
-    entries = list(chat_buffers.get(chat_id, []))
+    entries = chat_buffers.get(chat.id)
     if not entries:
         await update.message.reply_text("No recent text messages to capture for this chat.")
         return
+    # Format straight from the deque, before the first await can let new messages in.
+    body = "\n".join(f"[{e.ts}] {e.name}: {e.text}" for e in entries)
     await update.message.reply_text("⏳ Preparing transcript…")
 
-    chat_title = known_group_chats.get(chat_id, {}).get("title") or (chat.title or "")
+    chat_title = known_group_chats.get(chat.id, {}).get("title") or (chat.title or "")
     subject = chat_title  # subject = group name only
-    body_lines = []
-    for e in entries:
-        body_lines.append(f"[{e['ts']}] {e['name']}: {e['text']}")
-    body = "\n".join(body_lines)
 
     ok, err = await send_email_async(
         subject=subject,
@@ -1690,15 +2156,61 @@ async def sse_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def ssc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await _send_transcript_email(update, EMAIL_COI)
 
+# ---------------- Command dispatch ----------------
+# Every slash command, lowercased (Telegram commands match case-insensitively, so /Rules hits "rules").
+# One CommandHandler covers them all and picks the callback with a single dict lookup.
+COMMAND_TABLE = MappingProxyType({
+    "start": start,
+    "help": help_command,
+    "myid": myid,
+    "rules": rules_command,
+    **{cmd: generic_command_handler for cmd in COMMAND_MESSAGES},
+    "time": time_command,
+    "hours": time_command,  # alias
+    "coi": coi_command,
+    "ssi": ssi_command,
+    "sse": sse_command,
+    "ssc": ssc_command,
+    "who": who_command,
+    "broadcast": broadcast_command,
+    "broadcastexcept": broadcastexcept_command,
+    "broadcastpin": broadcastpin_command,
+    "broadcastto": broadcastto_command,
+    "aspe": aspe_command,
+    "aspr": aspr_command,
+    "oae": oae_command,
+    "aspcount": aspcount_command,
+    "aspwho": aspwho_command,
+    "aspbroadcaste": aspbroadcaste_command,
+    "aspbroadcastr": aspbroadcastr_command,
+    "aspbroadcast": aspbroadcast_command,
+    "refreshtitles": refreshtitles_command,
+    "findgroup": findgroup_command,
+    "exportgroups": exportgroups_command,
+    "matchinsured": matchinsured_command,
+})
+
+# Non-command filters, built once and shared with main()'s registrations
+NOT_COMMAND = ~filters.COMMAND
+# Update types requested from Telegram: exactly the message kinds the handlers above and below consume
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CHANNEL_POST, Update.EDITED_CHANNEL_POST]
+# Photo captions are not handled consistently by CommandHandler across PTB versions.
+BROADCASTEXCEPT_PHOTO = filters.PHOTO & filters.CaptionRegex(r"(?i)^/broadcastexcept(?:@\w+)?(?:\s|$)")
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = COMMAND_TABLE.get(_command_name(update.effective_message))
+    if handler:
+        await handler(update, context)
+
 # ---------------- Message handler (auto spiels) ----------------
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user
-    chat_id = str(chat.id)
-    now = now_in_timezone()
+    chat_id = chat.id
+    is_group = chat.type in GROUP_CHAT_TYPES
 
-    # Track groups + transcript + (maybe) authorize AIS members
-    if chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+    # Track groups + (maybe) authorize AIS members
+    if is_group:
         existing = known_group_chats.get(chat_id)
         title = chat.title or ""
         if not existing:
@@ -1707,100 +2219,140 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif title and existing.get("title") != title:
             await persist_known_group(chat_id, title)
             logger.info(f"Updated group title permanently: {chat_id}")
-    maybe_record_team_member(update)
-    record_message_for_transcript(update)
+    maybe_record_team_member(chat, user)
+
+    # COMMAND-ONLY MODE FOR AUTHORIZED GROUPS: nothing below (transcript, activity, spiels) applies there.
+    # Commands never reach this handler, so they are unaffected.
+    if chat_id in SILENT_GROUP_IDS:
+        return
+
+    now = now_in_timezone()
+    record_message_for_transcript(chat, user, update.effective_message)
 
     # Mark this group as active today. PostgreSQL preserves the full-day list through Railway restarts.
-    if chat.type in (Chat.GROUP, Chat.SUPERGROUP):
-        await mark_daily_activity(chat_id)
+    if is_group:
+        await mark_daily_activity(chat_id, now)
 
     is_auth = bool(user and is_authorized_user(user.id))
-    is_silent_chat = chat_id in SILENT_GROUP_IDS
-    is_group = chat.type in (Chat.GROUP, Chat.SUPERGROUP)
-
-    # COMMAND-ONLY MODE FOR AUTHORIZED GROUPS
-    if is_silent_chat:
-        return
 
     # Authorized messages: never auto-spiel; cancel any pending buffers; record timestamp
     if is_auth:
-        set_last_auth_msg(chat_id)
+        set_last_auth_msg(chat_id, now)
         cancel_all_pending_for_chat(chat_id)
         return
 
-    # From here, sender is non-authorized.
-
-    # Weekend: only act in group chats
-    if is_weekend():
-        if is_group:
-            schedule_buffered(chat_id, "WE", context)
-        return
-
-    # Lunch: only act in group chats
-    if is_lunch_time():
-        if is_group:
-            schedule_buffered(chat_id, "LUNCH", context)
+    # From here, sender is non-authorized. Only group chats get auto-spiels,
+    # and during open hours (before the cutoff) the bot stays silent.
+    state = office_state(now)
+    if not is_group or state is OfficeState.OPEN:
         return
 
-    # Business hours / cutoff handling
-    open_, before_cutoff = is_office_open()
-
-    def authorized_initiated_on_or_before_cutoff_today() -> bool:
+    # 4:30–5:00 PM: buffer cutoff unless an authorized user initiated on/before cutoff today
+    if state is OfficeState.CUTOFF:
         ts = LAST_AUTH_MSG_AT.get(chat_id)
-        if not ts:
-            return False
-        local_ts = ts.astimezone(TIMEZONE)
-        today_str = now.strftime("%Y-%m-%d")
-        return local_ts.strftime("%Y-%m-%d") == today_str and local_ts.time() <= WEEKDAY_CUTOFF
-
-    if open_:
-        if not before_cutoff:
-            # 4:30–5:00 PM: only in groups; buffer cutoff unless authorized initiated on/before cutoff
-            if is_group:
-                if not authorized_initiated_on_or_before_cutoff_today():
-                    schedule_buffered(chat_id, "CUTOFF", context)
-            return
-        else:
-            return  # before cutoff during open hours → stay silent
-
-    # After-hours (weekday): only in groups, schedule AM/PM
-    is_pm_after_shift = now.time() >= WEEKDAY_END  # >= 5:00 PM
-    is_am_before_shift = now.time() < WEEKDAY_START  # < 9:00 AM
+        if ts:
+            local_ts = ts.astimezone(TIMEZONE)
+            if local_ts.date() == now.date() and local_ts.time() <= WEEKDAY_CUTOFF:
+                return
 
-    if is_group:
-        if is_pm_after_shift:
-            schedule_buffered(chat_id, "PM", context)
-        elif is_am_before_shift:
-            schedule_buffered(chat_id, "AM", context)
+    # Weekend / lunch / cutoff / after-hours AM-PM: the state's value is the buffered period
+    schedule_buffered(chat_id, state.value, context)
     return
 
 # ---------------- Scheduler: 3:00 PM CT last call (weekdays, all chats active that day) ----------------
+async def send_last_call(bot, now_local: datetime) -> None:
+    """Send Last Call to every group active since midnight CT (silent/team groups excluded)."""
+    today = now_local.date()
+    roll_chat_activity(now_local)
+    active_ids = await get_active_group_ids(today)
+    targets = sorted(active_ids - SILENT_GROUP_IDS)
+    logger.info(f"Last Call targeting {len(targets)} groups active on {today}.")
+    await _fan_out(
+        targets, lambda cid: bot.send_message(chat_id=cid, text=LAST_CALL_MESSAGE, parse_mode="Markdown"), "Last Call"
+    )
+
+async def last_call_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback fired once a day at LAST_CALL_TIME; weekends are skipped here."""
+    now_local = now_in_timezone()
+    if now_local.weekday() >= 5:
+        return
+    await send_last_call(context.bot, now_local)
+
+def _seconds_until_next_last_call(now: datetime) -> float:
+    """Seconds from `now` to the next weekday LAST_CALL_TIME in CT (DST-safe: compared as timestamps)."""
+    day = now.date()
+    while True:
+        target = datetime.combine(day, LAST_CALL_TIME, tzinfo=TIMEZONE)
+        if target.weekday() < 5 and target > now:
+            return max(0.0, target.timestamp() - now.timestamp())
+        day += timedelta(days=1)
+
 async def last_call_scheduler(app):
-    last_run_date: Optional[str] = None
+    """Fallback used only when the JobQueue extra is not installed: one sleep per Last Call."""
+    last_run_date: Optional[date] = None
     while True:
-        now_local = now_in_timezone()
         try:
-            # Weekdays only, once at 3:00 PM CT. Includes every group active since midnight CT.
-            today_str = now_local.strftime("%Y-%m-%d")
-            if (now_local.weekday() < 5
-                    and now_local.time().hour == LAST_CALL_TIME.hour
-                    and now_local.time().minute == LAST_CALL_TIME.minute
-                    and last_run_date != today_str):
-                active_ids = await get_active_group_ids(today_str)
-                targets = sorted(cid for cid in active_ids if cid not in SILENT_GROUP_IDS)
-                last_run_date = today_str
-                logger.info(f"Last Call targeting {len(targets)} groups active on {today_str}.")
-                for chat_id in targets:
-                    try:
-                        await app.bot.send_message(chat_id=int(chat_id), text=LAST_CALL_MESSAGE, parse_mode="Markdown")
-                    except Exception as e:
-                        logger.error(f"Failed to send last call to {chat_id}: {e}")
-            await asyncio.sleep(60)
+            await asyncio.sleep(_seconds_until_next_last_call(now_in_timezone()))
+            now_local = now_in_timezone()
+            # A sleep that wakes a hair early re-arms for the same minute; the date guard keeps it to one send.
+            today = now_local.date()
+            if last_run_date != today:
+                last_run_date = today
+                await send_last_call(app.bot, now_local)
         except Exception:
             logger.exception("last_call_scheduler loop error")
             await asyncio.sleep(60)
 
 # ---------------- Main ----------------
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different chats concurrently but keeps each chat's updates in arrival order,
+    so a slow handler (email, broadcast, title refresh) in one chat no longer blocks every other chat.
+    """
+
+    # PTB's process_update takes its semaphore *before* do_process_update, so a slot would be held
+    # while waiting on a chat lock. Give PTB an effectively unbounded one and enforce the real limit
+    # ourselves, inside the chat lock: only updates that can actually run occupy a slot.
+    _UNBOUNDED = 2 ** 30
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(self._UNBOUNDED)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running:
+                await coroutine
+            return
+        cid = chat.id
+        lock = self._chat_locks.get(cid)
+        if lock is None:
+            lock = self._chat_locks[cid] = asyncio.Lock()
+        self._chat_waiters[cid] = self._chat_waiters.get(cid, 0) + 1
+        try:
+            async with lock:  # asyncio.Lock is FIFO, which preserves per-chat order
+                async with self._running:
+                    await coroutine
+        finally:
+            remaining = self._chat_waiters[cid] - 1
+            if remaining:
+                self._chat_waiters[cid] = remaining
+            else:
+                # Drop idle chats so the lock table only holds chats with work in flight.
+                del self._chat_waiters[cid]
+                del self._chat_locks[cid]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.exception("Unhandled error", exc_info=context.error)
 
@@ -1816,20 +2368,23 @@ def _acquire_conflict_guard(port: int) -> Optional[socket.socket]:
         logger.error(f"Another process appears to be running (conflict guard port {port} busy): {e}")
         return None
 
-async def main():
-    if not BOT_TOKEN:
-        print("❌ BOT_TOKEN not set"); return
-
-    # Email API check
-    if not SENDGRID_API_KEY:
-        logger.warning("SENDGRID_API_KEY missing — transcript emails will fail until set.")
+async def _post_stop(app) -> None:
+    """Stop our own tasks as soon as the application stops, before it is shut down."""
+    # Cancel AND await them so none is destroyed while still pending when the loop closes.
+    tasks = [t for t in (_FLOOD_WORKER, *BACKGROUND_TASKS) if t is not None and not t.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await flush_spiel_state()
 
-    # Optional conflict guard (same-host only)
-    guard_sock = _acquire_conflict_guard(CONFLICT_GUARD_PORT)
-    if guard_sock is None:
-        logger.error("Exiting due to conflict guard.")
-        return
+async def _post_shutdown(app) -> None:
+    """Release long-lived outbound resources once the application has shut down."""
+    await asyncio.get_running_loop().run_in_executor(None, close_email_clients)
+    if db_pool:
+        await db_pool.close()
 
+async def _post_init(app) -> None:
+    """Runs inside the application's own event loop, before the first update is fetched."""
     # Load persistent groups before the bot starts receiving updates.
     # Order: JSON backup first, then PostgreSQL, then save the merged unique list back to both.
     load_known_groups_from_json()
@@ -1842,54 +2397,87 @@ async def main():
     save_asp_groups_to_json()
     await sync_all_known_groups_to_db()
     await sync_all_asp_groups_to_db()
+    restore_pending_prompts(app.bot, await load_spiel_state_from_db(now_in_timezone()))
+    if db_pool:
+        _spawn_background(spiel_state_flusher())
     logger.info(f"✅ Persistent group registry ready: {len(known_group_chats)} unique groups loaded.")
     logger.info(f"✅ Persistent ASP registry ready: {len(asp_group_chats)} unique ASP groups loaded.")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    # Commands (authorized only)
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("myid", myid))
-    app.add_handler(CommandHandler("Rules", rules_command))
-    app.add_handler(CommandHandler("rules", rules_command))
-    app.add_handler(CommandHandler(["lt", "apd", "mvr", "sign", "emails"], generic_command_handler))
-    app.add_handler(CommandHandler("time", time_command))
-    app.add_handler(CommandHandler("hours", time_command))  # alias
-    app.add_handler(CommandHandler("coi", coi_command))
-    app.add_handler(CommandHandler("ssi", ssi_command))
-    app.add_handler(CommandHandler("sse", sse_command))
-    app.add_handler(CommandHandler("ssc", ssc_command))
-    app.add_handler(CommandHandler("who", who_command))
-    app.add_handler(CommandHandler("broadcast", broadcast_command))
-    app.add_handler(CommandHandler("broadcastexcept", broadcastexcept_command))
-    # Photo captions are not handled consistently by CommandHandler across PTB versions.
-    app.add_handler(MessageHandler(
-        filters.PHOTO & filters.CaptionRegex(r"(?i)^/broadcastexcept(?:@\w+)?(?:\s|$)"),
-        broadcastexcept_command,
-    ))
-    app.add_handler(CommandHandler("broadcastpin", broadcastpin_command))
-    app.add_handler(CommandHandler("broadcastto", broadcastto_command))
-    app.add_handler(CommandHandler("aspe", aspe_command))
-    app.add_handler(CommandHandler("aspr", aspr_command))
-    app.add_handler(CommandHandler("oae", oae_command))
-    app.add_handler(CommandHandler("aspcount", aspcount_command))
-    app.add_handler(CommandHandler("aspwho", aspwho_command))
-    app.add_handler(CommandHandler("aspbroadcaste", aspbroadcaste_command))
-    app.add_handler(CommandHandler("aspbroadcastr", aspbroadcastr_command))
-    app.add_handler(CommandHandler("aspbroadcast", aspbroadcast_command))
-    app.add_handler(CommandHandler("refreshtitles", refreshtitles_command))
-    app.add_handler(CommandHandler("findgroup", findgroup_command))
-    app.add_handler(CommandHandler("exportgroups", exportgroups_command))
-    app.add_handler(CommandHandler("matchinsured", matchinsured_command))
+    if app.job_queue is None:
+        logger.warning("JobQueue unavailable (python-telegram-bot[job-queue] not installed); using the fallback Last Call timer.")
+        _spawn_background(last_call_scheduler(app))
+
+def _install_event_loop(choice: str) -> str:
+    """Install the chosen loop policy before run_polling/run_webhook pick up the current loop; returns the one in use."""
+    # Alternative policies never create a loop implicitly, so each branch also sets a fresh one.
+    if choice == "uring":
+        try:
+            import uringcore
+            asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            return "uring"
+        except Exception as e:
+            asyncio.set_event_loop_policy(None)
+            logger.warning(f"io_uring event loop unavailable ({e}); falling back to uvloop.")
+            choice = "uv"
+    if choice == "uv" and UVLOOP_OK:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        return "uv"
+    return "default"
+
+def main():
+    if not BOT_TOKEN:
+        print("❌ BOT_TOKEN not set"); return
+
+    # Email API check
+    if EMAIL_CONFIG_ERROR:
+        logger.warning(f"{EMAIL_CONFIG_ERROR} — transcript emails will fail until set.")
+
+    # Optional conflict guard (same-host only)
+    guard_sock = _acquire_conflict_guard(CONFLICT_GUARD_PORT)
+    if guard_sock is None:
+        logger.error("Exiting due to conflict guard.")
+        return
+
+    logger.info(f"Event loop: {_install_event_loop(BOT_EVENT_LOOP)}")
+
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # CT is the JobQueue's default zone. Handlers stay blocking (block=True) so the per-chat
+        # processor above keeps ordering; concurrency across chats already comes from that processor.
+        .defaults(Defaults(tzinfo=TIMEZONE))
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+        # One pooled keep-alive client for sends; with h2 installed, concurrent sends multiplex on one TLS connection.
+        .connection_pool_size(TG_CONNECTION_POOL_SIZE)
+        .http_version("2" if HTTP2_OK else "1.1")
+        .get_updates_http_version("2" if HTTP2_OK else "1.1")
+    )
+    # Every outbound call goes through one token bucket, so fan-outs queue instead of hitting 429s.
+    global OUTBOUND_RATE_LIMITED
+    try:
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=TG_MAX_RETRIES))
+        OUTBOUND_RATE_LIMITED = True
+    except RuntimeError as e:
+        logger.warning(f"Outbound rate limiter disabled: {e}; broadcasts fall back to paced sequential sends.")
+    app = builder.build()
+
+    # Commands (authorized only): one handler, dict dispatch
+    app.add_handler(CommandHandler(list(COMMAND_TABLE), dispatch_command))
+    app.add_handler(MessageHandler(BROADCASTEXCEPT_PHOTO, broadcastexcept_command))
 
     # Messages
-    app.add_handler(MessageHandler(~filters.COMMAND, message_handler))
+    app.add_handler(MessageHandler(NOT_COMMAND, message_handler))
 
     app.add_error_handler(on_error)
 
-    # Kick off last-call scheduler
-    asyncio.create_task(last_call_scheduler(app))
+    # Last Call: a single daily JobQueue run at 3:00 PM CT instead of a per-minute polling loop
+    if app.job_queue is not None:
+        app.job_queue.run_daily(last_call_job, time=LAST_CALL_TIME, name="last_call")
 
     logger.info(
         "✅ Bot running: command-only authorized groups; 2h cooldown per group; "
@@ -1901,11 +2489,21 @@ async def main():
         "SendGrid email (plain-text transcripts, subject=group title); "
         "/who, /broadcast, /broadcastexcept, /broadcastpin, /broadcastto, /ASPE, /ASPR, /OAE, and ASP registry commands."
     )
-    await app.run_polling()
+    if WEBHOOK_URL and WEBHOOKS_OK:
+        # Telegram pushes each update to us: no getUpdates long-poll round-trip before a handler runs.
+        logger.info(f"Receiving updates via webhook at {WEBHOOK_URL}/{WEBHOOK_PATH} (port {WEBHOOK_PORT}).")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        return
+    if WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL is set but python-telegram-bot[webhooks] is not installed; using long polling.")
+    app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
-    try:
-        import nest_asyncio; nest_asyncio.apply()
-    except Exception:
-        pass
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file